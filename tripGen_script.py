@@ -1,56 +1,135 @@
 """
 Preprocess the trip
+
+Usage:
+    python tripGen_script.py run --data-dir <folder> --output plans.xml.gz
+    python tripGen_script.py cache --data-dir <folder>
+    python tripGen_script.py run --data-dir <folder> --output <shard folder> --shard-index 0 --shard-count 4
+    python tripGen_script.py merge --output <shard folder> --merged plans.xml.gz
 """
+import argparse
 import logging
 import numpy as np
 from pathlib import Path
 
 from sklearn.neighbors import BallTree
-import osmnx as ox
-import pandas as pd
 
-from tripGeneration.trip_preprocess import process_batch_trips
+from tripGeneration.trip_preprocess import check_enough_valid_trips, stream_batch_trips
 from tripGeneration.dataloader import load_required_dataset
 from tripGeneration.tripGeneration import map_single_trip
+from tripGeneration.matsim_writer import MatsimPlansWriter
+from tripGeneration import constants as c
+from tripGeneration import shard
 from tripGeneration import utils
 
 
 logging.basicConfig(level=logging.INFO)
 
-if __name__ == "__main__":
+
+def map_household_chunk(household_df, parsed_trips_list, taz_gdf, nodes, new_edges, poi_df, od_dict,
+                        balltree_taz, balltree_nodes, shortest_path_graph, plans_writer, seed,
+                        reachability_cache=None):
+    """
+    Map each person in the chunk and write the result before the next chunk is read.
+    Without a reachability cache, each person is written as soon as it is mapped. With it, persons are mapped
+    grouped by home TAZ so they share the shortest path searches from the same origin, and the results of
+    the chunk are buffered to be written back in file order.
+    Returns the number of persons written and failed.
+    """
+    if reachability_cache is None:
+        schedule = range(len(household_df))
+        map_result_list = None
+    else:
+        schedule = utils.schedule_by_home_taz(household_df, taz_gdf)
+        map_result_list = [None] * len(household_df)
+    written_counter = 0
+    failed_counter = 0
+    for person_idx in schedule:
+        person_id = household_df["id"].iloc[person_idx]
+        home_loc = [household_df["x"].iloc[person_idx], household_df["y"].iloc[person_idx]]
+        logging.debug(f"^^^^^^^^matching person {person_id} ^^^^^^^^^^")
+        np.random.seed(utils.get_person_seed(seed, person_id))
+        try:
+            map_result = map_single_trip(home_loc, parsed_trips_list[person_idx], taz_gdf, nodes,new_edges,poi_df,\
+                             od_dict,balltree_taz,balltree_nodes,shortest_path_graph,reachability_cache)
+        except Exception:
+            map_result = None
+        if map_result is None:
+            logging.debug(f"{person_id} matching failed.")
+            failed_counter += 1
+        elif map_result_list is None:
+            plans_writer.write_person(person_id, map_result)
+            written_counter += 1
+        else:
+            map_result_list[person_idx] = map_result
+
+    if map_result_list is not None:
+        for person_idx, map_result in enumerate(map_result_list):
+            if map_result is not None:
+                plans_writer.write_person(household_df["id"].iloc[person_idx], map_result)
+                written_counter += 1
+    return written_counter, failed_counter
+
+
+def get_shard_mask(household_df, shard_index, shard_count):
+    """
+    Boolean mask of the households that belong to this shard.
+    """
+    return np.array([utils.get_shard_index(person_id, shard_count) == shard_index
+                     for person_id in household_df["id"]], dtype=bool)
+
+
+def run(args):
     # step 1 : load data
     logging.info("==========================================")
     logging.info("=======       load data          =========")
     logging.info("==========================================")
-    file_path = "C:/Users/zhiyan/Desktop/sample_data"
-    data_dict = load_required_dataset(file_path)
-    trip_df = data_dict["activity_df"]
-    household_df = data_dict["household_df"]
+    sharded = args.shard_count is not None
+    if sharded and not 0 <= args.shard_index < args.shard_count:
+        raise ValueError(f"shard index {args.shard_index} is out of range for {args.shard_count} shards.")
+    data_dict = load_required_dataset(args.data_dir)
+    try:
+        generate_trips(args, data_dict, sharded)
+    finally:
+        # stop the loads that are still queued, e.g. when the mapping fails before they are used.
+        # a running load (e.g. the OSM fetch) is not waited for here, so the error is reported at once.
+        data_dict.shutdown(wait=False)
+
+
+def generate_trips(args, data_dict, sharded):
+    """
+    Map the households (of this shard) and write the plans, and the shard manifest when sharded.
+    """
+    # the precomputed travel time is not used by the mapping, so it is never loaded.
+    # activity and household data are streamed by chunks unless chunk_size is 0.
+    static_components = ["poi_df", "taz_gdf", "od_dict", "network_artifacts"]
+    if not args.chunk_size:
+        static_components += ["activity_df", "household_df"]
+    data_dict.prefetch(static_components)
+
+    # check the valid trips while the static components are loading, so an input without enough valid trips
+    # fails at once instead of after the network is fetched.
+    if not args.chunk_size:
+        activity_chunks = [data_dict["activity_df"]]
+        household_chunks = [data_dict["household_df"]]
+        _, households_total = check_enough_valid_trips(activity_chunks, household_chunks)
+    else:
+        _, households_total = check_enough_valid_trips(data_dict.iter_activity_chunks(args.chunk_size),
+                                                       data_dict.iter_household_chunks(args.chunk_size))
+        activity_chunks = data_dict.iter_activity_chunks(args.chunk_size)
+        household_chunks = data_dict.iter_household_chunks(args.chunk_size)
+
     poi_df = data_dict["poi_df"]
     taz_gdf = data_dict["taz_gdf"]
     od_dict = data_dict["od_dict"]
     #precomputed_travel_time_dict = data_dict["precomputed_travel_time_dict"]
-    network_graph = data_dict["network_graph"]
-    nodes, edges = ox.graph_to_gdfs(network_graph)
-    #new_edges = edges.reset_index()
-    new_edges = utils.generate_new_edges_df(edges)
-    shortest_path_graph,_ =utils.make_graph(new_edges)
+    nodes, new_edges, shortest_path_graph = data_dict["network_artifacts"]
 
     logging.info("==========================================")
     logging.info("=======       pre process          =======")
     logging.info("==========================================")
 
-    # step 2 : preprocess the trip and build BallTree
-    logging.info("*******Start to process daily trips*******")
-    parsed_trips_list=process_batch_trips(trip_df=trip_df,resolution=10)
-    if len(parsed_trips_list)<len(household_df):
-        raise ValueError(f"""
-        The number of valid trips should not be smaller than the number of person.
-        Got valid trips: {len(parsed_trips_list)}, number of households: {len(household_df)}.
-        """)
-    logging.info("*******Daily trips are preprocessed*******")
-    logging.info(f"raw trips number: {len(trip_df)}, valid trips number: {len(parsed_trips_list)}")
-
+    # step 2 : build BallTree. The daily trips are preprocessed chunk by chunk in step 3.
     logging.info("*******Start to build BallTree for TAZs and graph nodes*******")
     taz_coor_np = np.array([[p.x, p.y] for p in list(taz_gdf['centroid'])]).reshape((-1, 2))
     balltree_taz = BallTree(taz_coor_np, metric="minkowski")
@@ -61,22 +140,109 @@ if __name__ == "__main__":
     logging.info("=======       location matching    =======")
     logging.info("==========================================")
 
-    output_list = []
-    #for person_id in range(len(household_df)):
-    for person_id in range(20):
-        home_loc = [household_df["x"][person_id],household_df["y"][person_id]]
-        print(f"^^^^^^^^matching person {household_df['id'][person_id]} ^^^^^^^^^^")
-        try:
-            map_result = map_single_trip(home_loc, parsed_trips_list[person_id], taz_gdf, nodes,new_edges,poi_df,\
-                             od_dict,balltree_taz,balltree_nodes,shortest_path_graph)
-            if map_result is None:
-                print(f"{household_df['id'][person_id]} matching failed.")
-                continue
-            map_result_df = utils.parse_output(map_result)
-            map_result_df["person_id"] = household_df['id'][person_id]
-            print(map_result_df)
-            output_list.append(map_result_df)
-        except:
-            print(f"{household_df['id'][person_id]} matching failed.")
-    output_df = pd.concat(output_list, axis=0)
-    output_df.to_csv("C:/Users/Zhiyan/Desktop/output_df.csv")
\ No newline at end of file
+    if sharded:
+        Path(args.output).mkdir(parents=True, exist_ok=True)
+        plans_output_path, manifest_path = shard.get_shard_paths(args.output, args.shard_index, args.shard_count)
+    else:
+        plans_output_path = Path(args.output)
+
+    if args.schedule == "taz":
+        reachability_cache = utils.ReachabilityCache(shortest_path_graph, max_nodes=c.REACHABILITY_CACHE_NODES)
+    else:
+        reachability_cache = None
+
+    if sharded:
+        select_households = lambda household_df: get_shard_mask(household_df, args.shard_index, args.shard_count)
+    else:
+        select_households = None
+
+    households_assigned = 0
+    persons_written = 0
+    persons_failed = 0
+    with MatsimPlansWriter(plans_output_path) as plans_writer:
+        # only the trips of the selected households are fixed and parsed, the rest are just counted.
+        for household_chunk, parsed_trips_list in stream_batch_trips(activity_chunks, household_chunks,
+                                                                     resolution=10,
+                                                                     select_households=select_households):
+            households_assigned += len(household_chunk)
+            logging.info(f"*******Start to match {len(household_chunk)} persons*******")
+            written_counter, failed_counter = map_household_chunk(
+                household_chunk, parsed_trips_list, taz_gdf, nodes, new_edges, poi_df, od_dict,
+                balltree_taz, balltree_nodes, shortest_path_graph, plans_writer, args.seed, reachability_cache)
+            persons_written += written_counter
+            persons_failed += failed_counter
+            logging.info(f"*******{written_counter} persons matched, {failed_counter} failed*******")
+    logging.info(f"matched persons: {persons_written}, failed persons: {persons_failed}")
+    if reachability_cache is not None:
+        logging.info(reachability_cache.summary())
+
+    if sharded:
+        shard.write_manifest(manifest_path, {
+            "shard_index": args.shard_index,
+            "shard_count": args.shard_count,
+            "seed": args.seed,
+            "chunk_size": args.chunk_size,
+            "input_hashes": data_dict.input_hashes(),
+            "households_total": households_total,
+            "households_assigned": households_assigned,
+            "persons_written": persons_written,
+            "persons_failed": persons_failed,
+            "output_file": plans_output_path.name,
+            "output_sha256": shard.hash_output_file(plans_output_path),
+        })
+
+
+def cache(args):
+    # build the network artifacts once, so the shards started afterwards only load them.
+    data_dict = load_required_dataset(args.data_dir)
+    try:
+        data_dict["network_artifacts"]
+    finally:
+        data_dict.shutdown()
+
+
+def merge(args):
+    shard.merge_shard_outputs(args.output, args.merged)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Create stochastic daily trips as MATSim plans.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="map the daily trips of all (or one shard of) households")
+    run_parser.add_argument("--data-dir", required=True, help="folder with all required input data")
+    run_parser.add_argument("--output", required=True,
+                            help="plans file (.xml.gz), or the output folder when --shard-count is given")
+    run_parser.add_argument("--chunk-size", type=int, default=10000,
+                            help="number of persons read, preprocessed and mapped at a time, 0 reads the whole file at once")
+    run_parser.add_argument("--seed", type=int, default=0, help="random seed of the location mapping")
+    run_parser.add_argument("--schedule", choices=["taz", "file"], default="taz",
+                            help="map persons grouped by home TAZ within each chunk (sharing shortest path searches, "
+                                 "buffering the chunk) or in file order (writing each person at once)")
+    run_parser.add_argument("--shard-index", type=int, default=None,
+                            help="index of the shard to map, from 0 to --shard-count - 1")
+    run_parser.add_argument("--shard-count", type=int, default=None,
+                            help="split the households into this many shards and only map --shard-index")
+    run_parser.set_defaults(func=run)
+
+    cache_parser = subparsers.add_parser("cache", help="build the cached network artifacts")
+    cache_parser.add_argument("--data-dir", required=True, help="folder with all required input data")
+    cache_parser.set_defaults(func=cache)
+
+    merge_parser = subparsers.add_parser("merge", help="check and merge the shard outputs")
+    merge_parser.add_argument("--output", required=True, help="output folder of the shards")
+    merge_parser.add_argument("--merged", required=True, help="merged plans file (.xml.gz)")
+    merge_parser.set_defaults(func=merge)
+
+    args = parser.parse_args()
+    if args.command == "run" and (args.shard_index is None) != (args.shard_count is None):
+        run_parser.error("--shard-index and --shard-count must be given together")
+    if args.command == "run" and args.schedule == "taz" and not args.chunk_size:
+        # the taz schedule buffers the mapped plans of a whole chunk to restore the file order.
+        run_parser.error("--schedule taz needs a --chunk-size > 0, use --schedule file to read the whole file at once")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.func(args)
@@ -1,3 +1,9 @@
 SECONDS=60
 RADIUS_SPEED=20
-THRESHOLD=0.1
\ No newline at end of file
+THRESHOLD=0.1
+# number of nodes (settled plus frontier, over all origins) whose shortest path search is kept for reuse
+REACHABILITY_CACHE_NODES=1000000
+
+# MATSim output
+ACTIVITY_TYPES={1:"home", 2:"work"}
+MATSIM_DAY_START="2022/01/01 00:00:00"
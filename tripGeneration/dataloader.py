@@ -12,10 +12,16 @@ The required data are listed as follows:
     6. OSM network (by inputting the bounding box txt file (txt format)
 """
 
+from collections.abc import Mapping
+from concurrent.futures import Future, ThreadPoolExecutor
+import hashlib
 import logging
+import os
 import pathlib
 from pathlib import Path
 import pickle
+import threading
+import time
 
 import geopandas as gpd
 import networkx
@@ -23,8 +29,32 @@ import osmnx as ox
 import pandas as pd
 from shapely import wkt
 
+from . import utils
+
 logging.basicConfig(level=logging.INFO)
 
+DEFAULT_INPUT_FILENAMES = {
+    "stochastic_activity": "stochastic_activity.csv",
+    "household": "household.csv",
+    "taz": "taz.shp",
+    "poi": "poi.csv",
+    "od": "od_folder",
+    "network_bbox": "network_bbox.txt",
+    "precomputed_tt": "precomputed_tt.pkl",
+    "network_cache": "network_cache",
+}
+INPUT_DESCRIPTIONS = {
+    "stochastic_activity": "activity",
+    "household": "household",
+    "taz": "taz",
+    "poi": "POI",
+    "network_bbox": "network",
+    "precomputed_tt": "precomputed travel time pkl",
+}
+# components used by the mapping: the precomputed travel time is not needed, and network_artifacts already
+# contains what the mapping uses from network_graph.
+MAPPING_COMPONENTS = ["activity_df", "household_df", "poi_df", "taz_gdf", "od_dict", "network_artifacts"]
+
 
 def load_stochastic_activity_data(activity_filepath: pathlib.WindowsPath) -> pd.DataFrame:
     """
@@ -45,6 +75,24 @@ def load_stochastic_activity_data(activity_filepath: pathlib.WindowsPath) -> pd.
     return trip_df
 
 
+def load_stochastic_activity_chunks(activity_filepath: pathlib.WindowsPath, chunksize: int):
+    """
+    load activity data chunk by chunk, so only one chunk is held in memory.
+
+    Parameters
+    --------------------
+    activity_filepath: pathlib.WindowsPath
+        file path for activity file
+    chunksize: int
+        number of activity rows in each chunk
+
+    Returns
+    --------------------
+    activity_chunks : Iterator[pandas.DataFrame]
+    """
+    return pd.read_csv(activity_filepath, chunksize=chunksize)
+
+
 def load_household_location_data(household_filepath: pathlib.WindowsPath) -> pd.DataFrame:
     household_df = pd.read_csv(household_filepath)
     household_extract_df = household_df[["id","x","y"]]
@@ -52,6 +100,13 @@ def load_household_location_data(household_filepath: pathlib.WindowsPath) -> pd.
     return household_extract_df
 
 
+def load_household_location_chunks(household_filepath: pathlib.WindowsPath, chunksize: int):
+    """
+    load household data chunk by chunk. The row index keeps counting across chunks.
+    """
+    return pd.read_csv(household_filepath, usecols=["id","x","y"], chunksize=chunksize)
+
+
 def load_taz_data(taz_filepath: pathlib.WindowsPath) -> gpd.GeoDataFrame:
     """
     load TAZ shapefile.
@@ -152,96 +207,217 @@ def load_osm_network(north: float, south: float, east: float, west: float, crs:
     return proj_graph
 
 
-def load_required_dataset(folder_path, **kwargs):
-    logging.info("********start to load datasets********")
-    if "taz" in kwargs:
-        taz_filename = kwargs["taz"]
-    else:
-        taz_filename = "taz.shp"
+def load_network_bbox(network_bbox_filepath: pathlib.WindowsPath) -> list:
+    """
+    The network bbox txt file contains "north,south,east,west" of the study area.
+    """
+    with open(network_bbox_filepath) as f:
+        bbox_string_list = f.read().split(",")
+    return list(map(float, bbox_string_list))
 
-    if "network_bbox" in kwargs:
-        network_filename = kwargs["network_bbox"]
-    else:
-        network_filename = "network_bbox.txt"
 
-    if "stochastic_activity" in kwargs:
-        activity_filename = kwargs["stochastic_activity"]
-    else:
-        activity_filename = "stochastic_activity.csv"
+class RequiredDataset(Mapping):
+    """
+    Handle of the required datasets for trip generation.
 
-    if "household" in kwargs:
-        household_filename = kwargs["household"]
-    else:
-        household_filename = "household.csv"
+    Each component is loaded on first access (dataset["taz_gdf"]), so a run that only needs part of the data
+    does not pay for the rest. prefetch() starts loading several components at once on a thread pool, since
+    the components do not depend on each other. The load time of each component is logged.
+    It is a read-only Mapping of component name to data, so .get() works as on a dict, but .values() and
+    .items() load every component.
 
-    if "poi" in kwargs:
-        poi_filename = kwargs["poi"]
-    else:
-        poi_filename = "poi.csv"
+    Components:
+        activity_df, household_df, poi_df, taz_gdf, od_dict, network_graph, precomputed_travel_time_dict,
+        network_artifacts (nodes, new_edges, shortest_path_graph), cached in the network_cache folder
+    """
 
-    if "od" in kwargs:
-        od_folder = kwargs["od"]
+    def __init__(self, file_paths: dict, max_workers: int = None):
+        self.file_paths = file_paths
+        self._loaders = {
+            "activity_df": (self._load_activity, "stochastic_activity"),
+            "household_df": (self._load_household, "household"),
+            "poi_df": (self._load_poi, "poi"),
+            "taz_gdf": (self._load_taz, "taz"),
+            "od_dict": (self._load_od, "od"),
+            "network_graph": (self._load_network, "network_bbox"),
+            "precomputed_travel_time_dict": (self._load_precomputed_tt, "precomputed_tt"),
+            "network_artifacts": (self._load_network_artifacts, "network_bbox"),
+        }
+        self._max_workers = max_workers
+        self._executor = None
+        self._futures = dict()
+        self._lock = threading.Lock()
+
+    def _load_activity(self):
+        return load_stochastic_activity_data(self.file_paths["stochastic_activity"])
+
+    def _load_household(self):
+        return load_household_location_data(self.file_paths["household"])
+
+    def _load_poi(self):
+        return load_poi_data(self.file_paths["poi"])
+
+    def _load_taz(self):
+        return load_taz_data(self.file_paths["taz"])
+
+    def _load_od(self):
+        return load_od_data(self.file_paths["od"])
+
+    def _load_network(self):
+        north, south, east, west = load_network_bbox(self.file_paths["network_bbox"])
+        return load_osm_network(north, south, east, west)
+
+    def _load_precomputed_tt(self):
+        return load_precomputed_travel_time(self.file_paths["precomputed_tt"])
+
+    def _load_network_artifacts(self):
+        """
+        The artifacts only depend on the network bbox, so they are built once and reused by later runs
+        (e.g. every shard of a sharded run). The graph is fetched directly rather than through the
+        network_graph component, so a pool worker never waits on another queued load.
+        """
+        cache_dir = self.file_paths["network_cache"]
+        bbox_hash = hash_input_file(self.file_paths["network_bbox"])
+        cache_fp = cache_dir.joinpath(f"network_artifacts_{bbox_hash[:16]}.pkl")
+        if cache_fp.is_file():
+            with open(cache_fp, "rb") as f:
+                network_artifacts = pickle.load(f)
+            logging.info(f"========Network artifacts are loaded from cache {cache_fp}.=========")
+            return network_artifacts
+        network_artifacts = utils.build_network_artifacts(self._load_network())
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first, so concurrent runs never read a partially written cache.
+        tmp_fp = cache_fp.with_name(f"{cache_fp.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_fp, "wb") as f:
+            pickle.dump(network_artifacts, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_fp, cache_fp)
+        logging.info(f"========Network artifacts are cached in {cache_fp}.=========")
+        return network_artifacts
+
+    def _timed_load(self, name):
+        loader, file_key = self._loaders[name]
+        check_input_path(file_key, self.file_paths[file_key])
+        start = time.perf_counter()
+        data = loader()
+        logging.info(f"========{name} is loaded in {time.perf_counter() - start:.1f}s.========")
+        return data
+
+    def _submit(self, name) -> Future:
+        if name not in self._loaders:
+            raise KeyError(f"Unknown dataset component: {name}.")
+        with self._lock:
+            if name not in self._futures:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self._max_workers,
+                                                        thread_name_prefix="dataloader")
+                self._futures[name] = self._executor.submit(self._timed_load, name)
+            return self._futures[name]
+
+    def prefetch(self, names: list = None):
+        """
+        Start loading the given components (MAPPING_COMPONENTS by default) concurrently, without waiting for them.
+        """
+        if names is None:
+            names = MAPPING_COMPONENTS
+        for name in names:
+            self._submit(name)
+        return self
+
+    def iter_activity_chunks(self, chunksize: int):
+        check_input_path("stochastic_activity", self.file_paths["stochastic_activity"])
+        return load_stochastic_activity_chunks(self.file_paths["stochastic_activity"], chunksize)
+
+    def iter_household_chunks(self, chunksize: int):
+        check_input_path("household", self.file_paths["household"])
+        return load_household_location_chunks(self.file_paths["household"], chunksize)
+
+    def input_hashes(self) -> dict:
+        """
+        sha256 of every input used by the mapping, to check that runs (e.g. shards) used the same data.
+        """
+        hashes = dict()
+        for file_key in ["stochastic_activity", "household", "taz", "poi", "od", "network_bbox"]:
+            check_input_path(file_key, self.file_paths[file_key])
+            hashes[file_key] = hash_input_file(self.file_paths[file_key])
+        return hashes
+
+    def __iter__(self):
+        return iter(self._loaders)
+
+    def __len__(self):
+        return len(self._loaders)
+
+    def __contains__(self, name):
+        # overrides Mapping.__contains__, which would load the component.
+        return name in self._loaders
+
+    def __getitem__(self, name):
+        return self._submit(name).result()
+
+    def shutdown(self, wait: bool = True):
+        """
+        Cancel the loads that have not started yet, and wait for the running ones if wait is True.
+        The cancelled components are forgotten, so accessing them later starts a new load on a new pool.
+        """
+        with self._lock:
+            if self._executor is None:
+                return
+            for name, future in list(self._futures.items()):
+                if future.cancel():
+                    del self._futures[name]
+            executor = self._executor
+            self._executor = None
+        executor.shutdown(wait=wait)
+
+
+def hash_input_file(file_path: pathlib.WindowsPath) -> str:
+    """
+    sha256 of a file, or of all csv files in a folder (by name order).
+    """
+    sha = hashlib.sha256()
+    file_path = Path(file_path)
+    if file_path.is_dir():
+        file_list = sorted(f for f in file_path.iterdir() if f.suffix == ".csv")
     else:
-        od_folder = "od_folder"
+        file_list = [file_path]
+    for fp in file_list:
+        sha.update(fp.name.encode())
+        with open(fp, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def check_input_path(file_key, file_path):
+    if file_key == "od":
+        if not file_path.is_dir():
+            raise FileNotFoundError("The OD folder does not exist.")
+    elif not file_path.is_file():
+        raise FileNotFoundError(f"The {INPUT_DESCRIPTIONS[file_key]} file does not exist.")
 
-    if "precomputed_tt" in kwargs:
-        precomputed_tt_filename = kwargs["precomputed_tt"]
-    else:
-        precomputed_tt_filename = "precomputed_tt.pkl"
 
-    # check if those files exist
+def load_required_dataset(folder_path, max_workers: int = None, **kwargs) -> RequiredDataset:
+    """
+    Build the dataset handle of the files in folder_path. File names can be overridden by kwargs,
+    e.g. load_required_dataset(folder_path, taz="taz.csv"). Nothing is loaded until a component is accessed
+    or prefetched.
+    """
+    logging.info("********start to load datasets********")
     folder_dir = Path(folder_path)
-    od_dir = folder_dir.joinpath(od_folder)
-    taz_fp = folder_dir.joinpath(taz_filename)
-    poi_fp = folder_dir.joinpath(poi_filename)
-    network_fp = folder_dir.joinpath(network_filename)
-    activity_fp = folder_dir.joinpath(activity_filename)
-    household_fp = folder_dir.joinpath(household_filename)
-    precomputed_tt_fp = folder_dir.joinpath(precomputed_tt_filename)
-    # add hh distribution later
     if not folder_dir.is_dir():
         raise FileNotFoundError("The input file directory does not exist.")
-    if not od_dir.is_dir():
-        raise FileNotFoundError("The OD folder does not exist.")
-    if not taz_fp.is_file():
-        raise FileNotFoundError("The taz file does not exist.")
-    if not poi_fp.is_file():
-        raise FileNotFoundError("The POI file does not exist.")
-    if not network_fp.is_file():
-        raise FileNotFoundError("The network file does not exist.")
-    if not activity_fp.is_file():
-        raise FileNotFoundError("The activity file does not exist.")
-    if not household_fp.is_file():
-        raise FileNotFoundError("The household file does not exist.")
-    if not precomputed_tt_fp.is_file():
-        raise FileNotFoundError("The precomputed travel time pkl file does not exist.")
-    # add check for hh distribution later
-
-    # start to load each data
-    activity_df = load_stochastic_activity_data(activity_fp)
-    household_df = load_household_location_data(household_fp)
-    poi_df = load_poi_data(poi_fp)
-    taz_gdf = load_taz_data(taz_fp)
-    od_dict = load_od_data(od_dir)
-    precomputed_travel_time_dict = load_precomputed_travel_time(precomputed_tt_fp)
-    with open(network_fp) as f:
-        bbox_string_list = f.read().split(",")
-        north, south, east, west = list(map(float, bbox_string_list))
-        network_graph = load_osm_network(north, south, east, west)
-    # return the packed dataset in a dictionary
-    logging.info("********all required data are successfully loaded.********")
-    data_dict ={
-        "activity_df" : activity_df,
-        "household_df": household_df,
-        "poi_df" : poi_df,
-        "taz_gdf" : taz_gdf,
-        "od_dict" : od_dict,
-        "network_graph" : network_graph,
-        "precomputed_travel_time_dict" : precomputed_travel_time_dict
-    }
-    return data_dict
+    # add hh distribution later
+    file_paths = dict()
+    for file_key, default_filename in DEFAULT_INPUT_FILENAMES.items():
+        file_paths[file_key] = folder_dir.joinpath(kwargs.get(file_key, default_filename))
+    return RequiredDataset(file_paths, max_workers=max_workers)
 
 
 if __name__ == "__main__":
     filepath = "/Users/zhiyan_yi/Desktop/input_data"
-    load_required_dataset(filepath)
\ No newline at end of file
+    dataset = load_required_dataset(filepath).prefetch()
+    try:
+        for component in MAPPING_COMPONENTS:
+            dataset[component]
+    finally:
+        dataset.shutdown()
\ No newline at end of file
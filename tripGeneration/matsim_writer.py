@@ -0,0 +1,133 @@
+"""
+Write mapped daily trips as a MATSim plans file.
+"""
+from datetime import datetime
+import gzip
+import logging
+import os
+from pathlib import Path
+from xml.sax.saxutils import quoteattr
+
+from . import constants as c
+
+logging.basicConfig(level=logging.INFO)
+
+PLANS_HEADER = '<?xml version="1.0" encoding="utf-8"?>\n' \
+               '<!DOCTYPE population SYSTEM "http://www.matsim.org/files/dtd/population_v6.dtd">\n' \
+               '<population>\n'
+PLANS_FOOTER = '</population>\n'
+
+
+def format_matsim_time(t: datetime) -> str:
+    """
+    Convert the time into MATSim "HH:MM:SS" format.
+    Hours are counted from the simulated day start, so activities after midnight are written as 24:xx, 25:xx...
+    """
+    day_start = datetime.strptime(c.MATSIM_DAY_START, "%Y/%m/%d %H:%M:%S")
+    seconds = int((t - day_start).total_seconds())
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def format_minutes(minutes) -> str:
+    seconds = int(round(float(minutes) * 60))
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def build_person_xml(person_id, map_result: list, use_edge_index: bool = False) -> str:
+    """
+    Build the <person> element for one mapped person.
+
+    Parameters
+    --------------------
+    person_id:
+        the person (household) id
+    map_result: list
+        output of map_single_trip, i.e. [x, y, time, duration, purpose, nearest_edge_id, nearest_edge_index,
+        driving_minutes, est_time] for each activity. The time of row i is the departure from activity i-1,
+        so it is written as the end time of the previous activity.
+    use_edge_index: bool
+        if True, use nearest_edge_index as the MATSim link id, otherwise nearest_edge_id.
+
+    Returns
+    --------------------
+    person_xml: str
+    """
+    lines = [f"\t<person id={quoteattr(str(person_id))}>\n", '\t\t<plan selected="yes">\n']
+    for i, row in enumerate(map_result):
+        if i > 0:
+            leg_attrs = f'mode="car" dep_time="{format_matsim_time(row[2])}"'
+            if row[7] is not None:
+                leg_attrs += f' trav_time="{format_minutes(row[7])}"'
+            lines.append(f"\t\t\t<leg {leg_attrs}/>\n")
+        purpose = int(row[4])
+        act_type = c.ACTIVITY_TYPES.get(purpose, f"purpose_{purpose}")
+        link_id = row[6] if use_edge_index else row[5]
+        act_attrs = f'type={quoteattr(act_type)} x="{float(row[0])}" y="{float(row[1])}" link={quoteattr(str(link_id))}'
+        if i + 1 < len(map_result):
+            act_attrs += f' end_time="{format_matsim_time(map_result[i + 1][2])}"'
+        lines.append(f"\t\t\t<act {act_attrs}/>\n")
+    lines.append("\t\t</plan>\n")
+    lines.append("\t</person>\n")
+    return "".join(lines)
+
+
+class MatsimPlansWriter:
+    """
+    Stream mapped persons into a MATSim plans file (gzipped if the file name ends with .gz).
+    Each person is written as soon as it is mapped, so the memory usage does not grow with the population.
+    The file only appears at output_path when the with-block exits without an exception.
+
+    Usage:
+        with MatsimPlansWriter("plans.xml.gz") as writer:
+            writer.write_person(person_id, map_result)
+    """
+
+    def __init__(self, output_path, use_edge_index: bool = False):
+        self.output_path = Path(output_path)
+        # persons are written to a temporary file, which replaces output_path only when the run succeeds,
+        # so a failed run never leaves a complete-looking but truncated plans file.
+        self.tmp_path = self.output_path.with_name(f"{self.output_path.name}.tmp")
+        self.use_edge_index = use_edge_index
+        self.person_count = 0
+        self._file = None
+
+    def open(self):
+        if self.output_path.suffix == ".gz":
+            self._file = gzip.open(self.tmp_path, "wt", encoding="utf-8")
+        else:
+            self._file = open(self.tmp_path, "w", encoding="utf-8")
+        self._file.write(PLANS_HEADER)
+        return self
+
+    def write_person(self, person_id, map_result: list):
+        self._file.write(build_person_xml(person_id, map_result, self.use_edge_index))
+        self.person_count += 1
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.write(PLANS_FOOTER)
+        self._file.close()
+        self._file = None
+        os.replace(self.tmp_path, self.output_path)
+        logging.info(f"========{self.person_count} persons are written to {self.output_path}.========")
+
+    def abort(self):
+        """
+        Discard the partially written plans, output_path is left untouched.
+        """
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        self.tmp_path.unlink(missing_ok=True)
+        logging.error(f"========Writing {self.output_path} is aborted after {self.person_count} persons.========")
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
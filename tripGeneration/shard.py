@@ -0,0 +1,175 @@
+"""
+Sharded trip generation.
+
+Each shard maps the households whose id falls in its partition (utils.get_shard_index) and writes
+    part-<index>-of-<count>.xml.gz   the MATSim plans of the shard
+    part-<index>-of-<count>.json     the manifest (row counts, seed, input hashes, output hash)
+into the same output folder. merge_shard_outputs checks that all shards are present and consistent,
+and combines them into one plans file.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+from .matsim_writer import PLANS_HEADER, PLANS_FOOTER
+
+logging.basicConfig(level=logging.INFO)
+
+
+def get_shard_name(shard_index: int, shard_count: int) -> str:
+    return f"part-{shard_index:05d}-of-{shard_count:05d}"
+
+
+def get_shard_paths(output_dir, shard_index: int, shard_count: int):
+    """
+    Returns the (plans path, manifest path) of a shard.
+    """
+    output_dir = Path(output_dir)
+    plans_path = output_dir.joinpath(f"{get_shard_name(shard_index, shard_count)}.xml.gz")
+    return plans_path, get_manifest_path(plans_path)
+
+
+def get_manifest_path(plans_path):
+    """
+    The manifest sits next to the plans file, named after it without the .xml.gz / .gz / .xml suffix,
+    e.g. plans.v2.xml.gz -> plans.v2.json.
+    """
+    plans_path = Path(plans_path)
+    stem = plans_path.name
+    for suffix in [".xml.gz", ".gz", ".xml"]:
+        if stem.endswith(suffix):
+            stem = stem[:-len(suffix)]
+            break
+    return plans_path.with_name(f"{stem}.json")
+
+
+def hash_output_file(file_path) -> str:
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def write_manifest(manifest_path, manifest: dict):
+    """
+    The manifest is written last, so a shard without manifest is an unfinished shard.
+    """
+    tmp_path = Path(manifest_path).with_suffix(".json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    tmp_path.replace(manifest_path)
+    logging.info(f"========Manifest is written to {manifest_path}.========")
+
+
+def load_shard_manifests(output_dir) -> list:
+    """
+    Load and check the manifests of all shards in output_dir. Returns the manifests ordered by shard index.
+    """
+    manifest_paths = sorted(Path(output_dir).glob("part-*-of-*.json"))
+    if len(manifest_paths) == 0:
+        raise FileNotFoundError(f"No shard manifest is found in {output_dir}.")
+    manifests = []
+    for manifest_path in manifest_paths:
+        with open(manifest_path) as f:
+            manifests.append(json.load(f))
+
+    first = manifests[0]
+    shard_count = first["shard_count"]
+    for manifest in manifests:
+        for key in ["shard_count", "seed", "input_hashes", "households_total"]:
+            if manifest[key] != first[key]:
+                raise ValueError(f"Shard {manifest['shard_index']} has a different {key} from shard "
+                                 f"{first['shard_index']}: {manifest[key]} vs {first[key]}.")
+    shard_indices = sorted(manifest["shard_index"] for manifest in manifests)
+    missing = sorted(set(range(shard_count)) - set(shard_indices))
+    if missing:
+        raise ValueError(f"Shards {missing} of {shard_count} are missing in {output_dir}.")
+    if len(shard_indices) != shard_count:
+        raise ValueError(f"Expected {shard_count} shards, got manifests for shards {shard_indices}.")
+
+    households_assigned = sum(manifest["households_assigned"] for manifest in manifests)
+    if households_assigned != first["households_total"]:
+        raise ValueError(f"Shards cover {households_assigned} households, "
+                         f"but the household file has {first['households_total']}.")
+    for manifest in manifests:
+        if manifest["persons_written"] + manifest["persons_failed"] != manifest["households_assigned"]:
+            raise ValueError(f"Shard {manifest['shard_index']} is incomplete: "
+                             f"{manifest['persons_written']} written + {manifest['persons_failed']} failed "
+                             f"!= {manifest['households_assigned']} assigned.")
+    return sorted(manifests, key=lambda manifest: manifest["shard_index"])
+
+
+def merge_shard_outputs(output_dir, merged_path) -> dict:
+    """
+    Combine the plans of all shards into merged_path, after checking every shard is complete.
+    The persons are copied line by line, so the merge runs in constant memory.
+
+    Parameters
+    --------------------
+    output_dir:
+        folder with the shard plans and manifests
+    merged_path:
+        path of the merged plans file
+
+    Returns
+    --------------------
+    merged_manifest: dict
+        the manifest of the merged dataset, also written next to merged_path
+    """
+    output_dir = Path(output_dir)
+    merged_path = Path(merged_path)
+    manifests = load_shard_manifests(output_dir)
+    for manifest in manifests:
+        plans_path = output_dir.joinpath(manifest["output_file"])
+        if hash_output_file(plans_path) != manifest["output_sha256"]:
+            raise ValueError(f"{plans_path} does not match the hash in its manifest.")
+
+    # persons are copied to a temporary file, which replaces merged_path only when every shard passes its
+    # check, so a failed or interrupted merge never leaves a complete-looking but truncated plans file.
+    tmp_path = merged_path.with_name(f"{merged_path.name}.tmp")
+    persons_written = 0
+    try:
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as merged_file:
+            merged_file.write(PLANS_HEADER)
+            for manifest in manifests:
+                shard_persons = 0
+                in_population = False
+                with gzip.open(output_dir.joinpath(manifest["output_file"]), "rt", encoding="utf-8") as shard_file:
+                    for line in shard_file:
+                        if line.startswith("<population"):
+                            in_population = True
+                            continue
+                        if line.startswith("</population"):
+                            in_population = False
+                            continue
+                        if in_population:
+                            if line.startswith("\t<person "):
+                                shard_persons += 1
+                            merged_file.write(line)
+                if shard_persons != manifest["persons_written"]:
+                    raise ValueError(f"Shard {manifest['shard_index']} has {shard_persons} persons, "
+                                     f"but its manifest records {manifest['persons_written']}.")
+                persons_written += shard_persons
+            merged_file.write(PLANS_FOOTER)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, merged_path)
+
+    merged_manifest = {
+        "shard_count": manifests[0]["shard_count"],
+        "seed": manifests[0]["seed"],
+        "input_hashes": manifests[0]["input_hashes"],
+        "households_total": manifests[0]["households_total"],
+        "persons_written": persons_written,
+        "persons_failed": sum(manifest["persons_failed"] for manifest in manifests),
+        "output_file": merged_path.name,
+        "output_sha256": hash_output_file(merged_path),
+    }
+    write_manifest(get_manifest_path(merged_path), merged_manifest)
+    logging.info(f"========{len(manifests)} shards with {persons_written} persons are merged into {merged_path}.========")
+    return merged_manifest
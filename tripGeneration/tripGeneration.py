@@ -12,6 +12,7 @@ from shapely.geometry import Point
 from . import constants as c
 from .utils import (get_nearest_edge,
                     find_qualified_tazs_using_shortestpath,
+                    find_qualified_tazs_using_reachability,
                     find_qualified_tazs_with_poi,
                     get_random_taz_destination,
                     select_poi)
@@ -29,7 +30,8 @@ def map_single_trip(
         od_dict: dict,
         balltree_taz,
         balltree_nodes,
-        shortest_path_graph):
+        shortest_path_graph,
+        reachability_cache=None):
 
     start_loc = home_loc
     work_loc = None
@@ -74,7 +76,10 @@ def map_single_trip(
         # 2. search qualified TAZs that can be rearched around the driving time
         iter_time = 0
         while True:
-            qualified_time_tazs = find_qualified_tazs_using_shortestpath(start_taz_nearest_node, qualified_tazs, driving_time*c.SECONDS,c.THRESHOLD,shortest_path_graph)
+            if reachability_cache is None:
+                qualified_time_tazs = find_qualified_tazs_using_shortestpath(start_taz_nearest_node, qualified_tazs, driving_time*c.SECONDS,c.THRESHOLD,shortest_path_graph)
+            else:
+                qualified_time_tazs = find_qualified_tazs_using_reachability(start_taz_nearest_node, qualified_tazs, driving_time*c.SECONDS,c.THRESHOLD,reachability_cache)
             if len(qualified_time_tazs) != 0:
                 break
             driving_time=driving_time//2
@@ -51,3 +51,80 @@ def process_batch_trips(trip_df: pd.DataFrame, resolution: int) ->list:
         else:
             trip_list.append(parsed_daily_trip)
     return trip_list
+
+
+def is_valid_trip(daily_trip) -> bool:
+    # same check as step 1 of process_single_trip, without fixing and parsing the trip.
+    return utils.if_driving_today(daily_trip) and utils.is_connected_by_driving(daily_trip)
+
+
+def check_enough_valid_trips(activity_chunks, household_chunks):
+    """
+    Count the valid trips and households before any person is mapped, so a run without enough valid trips
+    fails at the start rather than after the earlier chunks are mapped.
+
+    :param activity_chunks: iterable of activity dataframes
+    :param household_chunks: iterable of household dataframes
+    :return: (number of valid trips, number of households)
+    """
+    valid_trip_counter = 0
+    for trip_chunk in activity_chunks:
+        for daily_trip in trip_chunk.itertuples(index=False, name=None):
+            if is_valid_trip(list(daily_trip)):
+                valid_trip_counter += 1
+    household_counter = sum(len(household_chunk) for household_chunk in household_chunks)
+    if valid_trip_counter < household_counter:
+        raise ValueError(f"""
+        The number of valid trips should not be smaller than the number of person.
+        Got valid trips: {valid_trip_counter}, number of households: {household_counter}.
+        """)
+    return valid_trip_counter, household_counter
+
+
+def stream_batch_trips(activity_chunks, household_chunks, resolution: int, select_households=None):
+    """
+    Pair households with valid daily trips chunk by chunk.
+    The i-th household gets the i-th valid trip, same as process_batch_trips on the whole activity data,
+    but only the current chunks (plus the valid trips left over from the last activity chunk) are in memory.
+    The pairing only needs the cheap validity check, so a trip is fixed and parsed only when its household
+    is selected (e.g. the households of one shard).
+
+    :param activity_chunks: iterable of activity dataframes
+    :param household_chunks: iterable of household dataframes
+    :param resolution:
+    :param select_households: function of a household chunk returning a boolean mask of the households
+        to keep, all households are kept by default
+    :return: generator of (selected household_chunk, parsed_trips_list), both with the same length
+    """
+    activity_iter = iter(activity_chunks)
+    pending_trips = []
+    raw_trip_counter = 0
+    valid_trip_counter = 0
+    for household_chunk in household_chunks:
+        person_num = len(household_chunk)
+        while len(pending_trips) < person_num:
+            try:
+                trip_chunk = next(activity_iter)
+            except StopIteration:
+                raise ValueError(f"""
+                The number of valid trips should not be smaller than the number of person.
+                Got valid trips: {valid_trip_counter}, raw trips: {raw_trip_counter}.
+                """)
+            if trip_chunk.shape[1] * resolution != 24 * 60:
+                raise ValueError("The time step of activity does not match with resolution!")
+            for daily_trip in trip_chunk.itertuples(index=False, name=None):
+                daily_trip = list(daily_trip)
+                if is_valid_trip(daily_trip):
+                    pending_trips.append(daily_trip)
+                    valid_trip_counter += 1
+            raw_trip_counter += len(trip_chunk)
+        if select_households is None:
+            household_mask = [True] * person_num
+        else:
+            household_mask = list(select_households(household_chunk))
+        parsed_trips_list = [process_single_trip(daily_trip=daily_trip)
+                             for daily_trip, selected in zip(pending_trips[:person_num], household_mask)
+                             if selected]
+        yield household_chunk[household_mask], parsed_trips_list
+        pending_trips = pending_trips[person_num:]
+    logging.info(f"raw trips number: {raw_trip_counter}, valid trips number: {valid_trip_counter}")
@@ -2,10 +2,13 @@
 Basic util functions
 """
 
+from collections import OrderedDict
 from datetime import datetime, timedelta
+import heapq
 import logging
 import pathlib
 from pathlib import Path
+import zlib
 
 from dijkstar import Graph, find_path
 import geopandas as gpd
@@ -158,6 +161,124 @@ def find_qualified_tazs_using_shortestpath(
     return output_gdf
 
 
+class ReachabilityCache:
+    """
+    Shortest travel times from an origin node to all nodes within a bound, shared by every trip that starts
+    at the same node (e.g. persons living in the same TAZ).
+    The Dijkstra search of each origin is kept with its frontier, so a query with a larger bound resumes the
+    search instead of starting over, and a query with a smaller bound is answered without any search.
+    The least recently used searches are dropped once the kept searches hold more than max_nodes entries
+    (settled nodes plus frontier), so the memory does not grow with the number of origins.
+    """
+
+    def __init__(self, graph, max_nodes: int = 1000000):
+        self.graph = graph
+        self.max_nodes = max_nodes
+        self._searches = OrderedDict()
+        self._cached_nodes = 0
+        self.query_counter = 0
+        self.path_query_counter = 0
+        self.search_counter = 0
+        self.resume_counter = 0
+        self.hit_counter = 0
+        self.settled_counter = 0
+        self.evict_counter = 0
+
+    def get_travel_times(self, origin, bound) -> dict:
+        """
+        Returns the dict {node: shortest travel time from origin}, complete for all nodes within bound.
+        """
+        self.query_counter += 1
+        search = self._searches.get(origin)
+        if search is None:
+            search = {"bound": -1, "settled": dict(), "tentative": {origin: 0}, "frontier": [(0, origin)]}
+            self._searches[origin] = search
+            self.search_counter += 1
+            size_before = 0
+        else:
+            self._searches.move_to_end(origin)
+            if bound <= search["bound"]:
+                self.hit_counter += 1
+                return search["settled"]
+            self.resume_counter += 1
+            size_before = self._search_size(search)
+        self._expand(search, bound)
+        self._cached_nodes += self._search_size(search) - size_before
+        self._evict(keep=origin)
+        return search["settled"]
+
+    @staticmethod
+    def _search_size(search) -> int:
+        return len(search["settled"]) + len(search["frontier"])
+
+    def _evict(self, keep):
+        # the search of the current origin is kept even if it alone exceeds max_nodes, it is needed now.
+        while self._cached_nodes > self.max_nodes and len(self._searches) > 1:
+            origin, search = next(iter(self._searches.items()))
+            if origin == keep:
+                break
+            del self._searches[origin]
+            self._cached_nodes -= self._search_size(search)
+            self.evict_counter += 1
+
+    def _expand(self, search, bound):
+        settled = search["settled"]
+        tentative = search["tentative"]
+        frontier = search["frontier"]
+        while frontier:
+            cost, node = frontier[0]
+            if cost > bound:
+                break
+            heapq.heappop(frontier)
+            if node in settled:
+                continue
+            del tentative[node]
+            settled[node] = cost
+            self.settled_counter += 1
+            for next_node, edge_cost in self.graph.get(node, {}).items():
+                next_cost = cost + edge_cost
+                # only push when the best known travel time improves, so the frontier stays small.
+                if next_node not in settled and next_cost < tentative.get(next_node, float("inf")):
+                    tentative[next_node] = next_cost
+                    heapq.heappush(frontier, (next_cost, next_node))
+        search["bound"] = bound
+
+    def summary(self) -> str:
+        return (f"{self.path_query_counter} single-pair shortest path searches are replaced by "
+                f"{self.search_counter} single-source searches ({self.resume_counter} resumed from a kept "
+                f"frontier); {self.hit_counter} of {self.query_counter} reachability queries needed no search; "
+                f"{self.settled_counter} nodes settled in total, {self.evict_counter} searches dropped "
+                f"to stay within {self.max_nodes} cached nodes.")
+
+
+def find_qualified_tazs_using_reachability(
+        start_node,
+        qualified_tazs_gdf,
+        driving_time,
+        threshold,
+        reachability_cache):
+    """
+    Same as find_qualified_tazs_using_shortestpath, but the travel times from start_node are looked up in
+    the reachability cache, instead of searching a shortest path to every TAZ.
+    """
+    taz_ids = list(qualified_tazs_gdf['TAZID'])
+    taz_nereast_nodes = list(qualified_tazs_gdf['nearest_node'])
+    upper_bound = driving_time*(1+threshold)
+    lower_bound = driving_time*(1-threshold)
+    travel_times = reachability_cache.get_travel_times(start_node, upper_bound)
+    reachability_cache.path_query_counter += len(taz_nereast_nodes)
+    output_index = []
+    est_time=[]
+    for i, n in enumerate(taz_nereast_nodes):
+        travel_time = travel_times.get(n, 100000)
+        if lower_bound<=travel_time<=upper_bound:
+            output_index.append(taz_ids[i])
+            est_time.append(travel_time)
+    output_gdf= qualified_tazs_gdf[qualified_tazs_gdf['TAZID'].isin(output_index)]
+    output_gdf['est_time']=est_time
+    return output_gdf
+
+
 def make_graph(edges_df):
     graph = Graph()
     u = list(edges_df['u'])
@@ -271,6 +392,54 @@ def get_osm_travel_time(trip_df,new_edges,shortest_path_graph):
     return trip_df
 
 
+def build_network_artifacts(network_graph):
+    """
+    Build what the mapping needs from the OSM graph: nodes, de-duplicated edges and the shortest path graph.
+    """
+    nodes, edges = ox.graph_to_gdfs(network_graph)
+    new_edges = generate_new_edges_df(edges)
+    shortest_path_graph, _ = make_graph(new_edges)
+    return nodes, new_edges, shortest_path_graph
+
+
+def get_shard_index(person_id, shard_count: int) -> int:
+    """
+    Deterministic shard of a household id, independent of the file order and the Python hash seed.
+    """
+    return zlib.crc32(str(person_id).encode()) % shard_count
+
+
+def get_person_seed(seed: int, person_id) -> int:
+    """
+    Random seed for a single person, so the result of a person does not depend on which shard maps it
+    or on the order persons are mapped in.
+    """
+    return zlib.crc32(f"{seed}:{person_id}".encode())
+
+
+def assign_home_taz(household_df, taz_gdf) -> pd.Series:
+    """
+    Find the TAZ of every household with one spatial join. Households outside all TAZs get NaN.
+    """
+    household_gdf = gpd.GeoDataFrame(household_df[["id"]],
+                                     geometry=gpd.points_from_xy(household_df["x"], household_df["y"]))
+    joined_gdf = gpd.sjoin(household_gdf, taz_gdf[["TAZID", "geometry"]], how="left", predicate="within")
+    # a household on the border of two TAZs is matched twice, keep the first one.
+    joined_gdf = joined_gdf[~joined_gdf.index.duplicated(keep="first")]
+    return joined_gdf["TAZID"].reindex(household_df.index)
+
+
+def schedule_by_home_taz(household_df, taz_gdf) -> list:
+    """
+    Positions of the households ordered by home TAZ (file order within the same TAZ), so persons sharing
+    an origin are mapped one after another and can reuse the same shortest path search.
+    """
+    home_taz = assign_home_taz(household_df, taz_gdf).reset_index(drop=True)
+    order = home_taz.sort_values(kind="mergesort", na_position="last").index
+    logging.info(f"{len(household_df)} persons are grouped into {home_taz.nunique()} home TAZs.")
+    return list(order)
+
+
 def generate_new_edges_df(edges):
     new_edges=edges.copy()
     new_edges=new_edges.reset_index()